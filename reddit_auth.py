@@ -1,8 +1,8 @@
 import socket
 import sys
 import time
-from praw import Reddit  # type: ignore
 
+from src.reddit_client import get_reddit_client
 from src.reddit_utils import REDDIT_CONFIG_FILENAME, load_reddit_config
 
 # Modified from https://praw.readthedocs.io/en/stable/tutorials/refresh_token.html#obtaining-refresh-tokens
@@ -14,12 +14,8 @@ def retrieve_refresh_token() -> int:
 	config = load_reddit_config(auth_session=True)
 	redirect_host = 'localhost'
 	redirect_port = 8080
-	reddit = Reddit(
-	    client_id=config.client_id,
-	    client_secret=config.client_secret,
-	    user_agent=config.user_agent,
-	    redirect_uri=f"http://{redirect_host}:{redirect_port}",
-	)
+	assert config.user_agent
+	reddit = get_reddit_client(config.client_id, config.client_secret, config.user_agent, redirect_uri=f"http://{redirect_host}:{redirect_port}")
 
 	state = str(time.time())
 	url = reddit.auth.url(duration="permanent", scopes=SCOPES, state=state)
@@ -1,54 +1,63 @@
 import argparse
-from datetime import datetime
-from enum import Enum
 import logging
 import os
 import sys
-import yaml
-from praw import Reddit  # type: ignore
+import time
+from typing import TYPE_CHECKING, Callable
 
-from src.agent_env import AgentEnv
 from src.formatted_logger import FmtText, FormattedLogger, LogLevel, fmtlog, log_container
 from src.log_config import FileLogger, StdStreamLogger, logger
-from src.agent import run_agent
-from src.reddit_utils import LoadConfigException, load_reddit_config
-from src.pydantic_models.agent_config import AgentConfig
-from src.providers.openai_provider import OpenAIProvider
-from src.pydantic_models.openai_config import OpenAIConfig
 
+# praw, yaml, pydantic and openai are imported inside the functions that use them,
+# so that '--help' and argument errors don't pay for loading them.
+if TYPE_CHECKING:
+	from src.providers.base_provider import BaseProvider
+	from src.pydantic_models.reddit_config import RedditConfig
+	from src.utils import ModelT
 
-def initialize_reddit():
-	try:
-		config = load_reddit_config()
-	except LoadConfigException:
-		logger.exception()
-		sys.exit(1)
-	reddit = Reddit(
-	    client_id=config.client_id,
-	    client_secret=config.client_secret,
-	    user_agent=config.user_agent,
-	    refresh_token=config.refresh_token,
-	)
-	fmtlog([FmtText(f"Logged in as: {reddit.user.me()}")])
+LOG_LEVELS = logging.getLevelNamesMapping()
+
+
+def create_reddit_client(config: 'RedditConfig'):
+	from src.reddit_client import get_reddit_client
+
+	assert config.user_agent
+	return get_reddit_client(config.client_id, config.client_secret, config.user_agent, refresh_token=config.refresh_token)
+
+
+def initialize_reddit(config: 'RedditConfig'):
+	reddit = create_reddit_client(config)
+	fmtlog([FmtText(f"Logged in as: {config.username or reddit.user.me()}")])
 	return reddit
 
 
-def load_config(path: str):
-	if os.path.exists(path):
-		with open(path) as f:
-			return yaml.safe_load(f)
-	else:
-		raise FileNotFoundError(f"File {path} not found. Create it by copying {path}.example to {path} and edit the values.")
+def load_config(path: str, model_cls: type['ModelT']) -> 'ModelT':
+	from src.utils import load_model_file
+
+	try:
+		return load_model_file(path, model_cls)
+	except FileNotFoundError:
+		raise FileNotFoundError(f"File {path} not found. Create it by copying {path}.example to {path} and edit the values.") from None
+
+
+def create_openai_provider() -> 'BaseProvider':
+	from src.providers.openai_provider import OpenAIProvider
+	from src.pydantic_models.openai_config import OpenAIConfig
+
+	return OpenAIProvider(load_config('config/openai_config.yaml', OpenAIConfig))
+
+
+PROVIDERS: dict[str, Callable[[], 'BaseProvider']] = {
+    'openai': create_openai_provider,
+}
 
 
 def run():
-	Providers = Enum('KnownProviders', ['openai'])
-	available_providers = [provider.name for provider in Providers]
 	parser = argparse.ArgumentParser()
-	parser.add_argument("agent_schema_file", type=str, help="Path to the agent schema file.")
-	parser.add_argument("provider", type=str, help=f"AI provider to use. Available providers: {', '.join(available_providers)}")
+	parser.add_argument("agent_schema_file", type=str, help="Path to the agent schema file (YAML, or JSON with a .json extension).")
+	parser.add_argument("provider", type=str, choices=tuple(PROVIDERS), help="AI provider to use.")
 	parser.add_argument("--test_mode", action="store_true", help="Enable confirmation before each action or step. Create post will always be available.")
-	parser.add_argument("--log_level", type=str, default="DEBUG", help="Set the log level for the log file. Default: DEBUG")
+	parser.add_argument("--log_level", type=str, choices=tuple(LOG_LEVELS), default="DEBUG", help="Set the log level for the log file. Default: DEBUG")
 	parser.add_argument("--log_dir", type=str, help="Directory to save logs (default: current working directory)", default=os.getcwd())
 	args = parser.parse_args()
 	assert isinstance(args.agent_schema_file, str)
@@ -57,42 +66,43 @@ def run():
 	assert isinstance(args.log_level, str)
 	assert isinstance(args.log_dir, str)
 
-	log_level = logging.getLevelNamesMapping().get(args.log_level)
-	if log_level is None:
-		raise ValueError(f"Invalid log level: {args.log_level}")
+	log_level = LOG_LEVELS[args.log_level]
 
-	log_filename = datetime.now().isoformat(sep="_", timespec="seconds").replace(":", "-") + ".log.md"
-	print(f"Logging to {os.path.join(args.log_dir, log_filename)}")
 	stream_logger = StdStreamLogger(LogLevel.INFO)
-	file_logger = FileLogger(os.path.join(args.log_dir, log_filename), log_level)
-	logger.register_logger(file_logger)
 	logger.register_logger(stream_logger)
 
-	formatted_logger = FormattedLogger(file_logger)
-	log_container.register_logger(formatted_logger)
+	from src.agent import run_agent
+	from src.agent_env import AgentEnv
+	from src.pydantic_models.agent_config import AgentConfig
+	from src.reddit_utils import LoadConfigException, load_reddit_config
+	from src.utils import load_yaml_file
 
-	reddit = initialize_reddit()
+	try:
+		reddit_config = load_reddit_config()
+	except LoadConfigException:
+		logger.exception()
+		sys.exit(1)
 
-	if args.provider not in [provider.name for provider in Providers]:
-		raise ValueError(f"Unknown provider: {args.provider}. Available providers: {', '.join(available_providers)}")
-	provider_enum = Providers[args.provider]
-	fmtlog([FmtText(f'Using provider: {provider_enum.name}')])
+	provider = PROVIDERS[args.provider]()
 
-	if provider_enum.name == Providers.openai.name:
-		config_obj = load_config('config/openai_config.yaml')
-		config = OpenAIConfig(**config_obj)
-		provider = OpenAIProvider(config)
-	else:
-		raise ValueError(f"Provider not implemented: {provider_enum.name}")
+	agent_config = AgentConfig(**load_yaml_file(args.agent_schema_file))
 
-	with open(args.agent_schema_file) as f:
-		agent_schema_obj = yaml.safe_load(f)
+	# The log file is only created once all configuration has been loaded and validated
+	log_filename = time.strftime("%Y-%m-%d_%H-%M-%S") + ".log.md"
+	print(f"Logging to {os.path.join(args.log_dir, log_filename)}")
+	file_logger = FileLogger(os.path.join(args.log_dir, log_filename), log_level)
+	logger.register_logger(file_logger)
+
+	formatted_logger = FormattedLogger(file_logger)
+	log_container.register_logger(formatted_logger)
 
-	agent_config = AgentConfig(**agent_schema_obj)
+	reddit = initialize_reddit(reddit_config)
+	fmtlog([FmtText(f'Using provider: {args.provider}')])
 	fmtlog([FmtText(f'Loaded agent: {agent_config.name}')])
 
 	agent_state_filename = 'agent_state.json'
-	agent_env = AgentEnv(agent_state_filename, agent_config, provider, reddit, args.test_mode)
+	inbox_reddit = create_reddit_client(reddit_config)  # Used by the inbox stream's thread only
+	agent_env = AgentEnv(agent_state_filename, agent_config, provider, reddit, inbox_reddit, args.test_mode, reddit_config.username or None)
 	run_agent(agent_env)
 
 
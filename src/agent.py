@@ -1,83 +1,144 @@
+import atexit
+from collections import deque
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-import json
-import queue
+import functools
 import threading
 import time
 from typing import Any
 from src.log_config import logger
 from src.formatted_logger import FmtCode, FmtHeader, FmtText, fmtlog
-from praw.models import Submission  # type: ignore
+from praw.models import Comment, Submission  # type: ignore
+from praw.models.util import ExponentialCounter  # type: ignore
 from src.commands import AgentEnv, ReplyToContent
 from src.pydantic_models.agent_state import HistoryItem, StreamedSubmission
-from src.reddit_utils import COMMENT_PREFIX, SubmissionTreeNode, find_content_in_submission_tree, get_author_name, get_comment_tree, get_current_user, list_inbox_comments, show_conversation
-from src.utils import confirm_enter, confirm_yes_no, yaml_dump
+from src.reddit_utils import COMMENT_PREFIX, SubmissionTreeNode, find_content_in_submission_tree, get_author_name, get_comment_tree, show_conversation
+from src.utils import confirm_enter, confirm_yes_no, json_dumps_compact, yaml_dump
 
-submission_queue: queue.Queue[Submission] = queue.Queue()
+# Filled by the streaming thread and emptied by the main loop. With a single producer and a single consumer,
+# deque's append() and popleft() are atomic and don't need the locks of queue.Queue.
+submission_queue: deque[Submission] = deque()
+# Set when there is new work, so the main loop doesn't have to sleep out its full polling interval
+new_event_available = threading.Event()
+# With pause_after=0, PRAW's streams yield None after each poll without new items instead of sleeping themselves.
+# The loops then wait with an increasing delay, up to this many seconds, like PRAW does, until new items arrive.
+STREAM_MAX_IDLE_SECONDS = 16
 
 
-def already_streamed(env: AgentEnv, submission: Submission) -> bool:
-	for s in env.state.streamed_submissions:
-		if s.id == submission.id:
-			return True
-	return False
+AGE_FILTER_INTERVAL_SECONDS = 60
+
+
+def drain_submission_queue() -> list[Submission]:
+	submissions: list[Submission] = []
+	while submission_queue:
+		submissions.append(submission_queue.popleft())
+	return submissions
 
 
 def stream_submissions_to_state(env: AgentEnv, wait_once: bool = False):
-	while True:
-		try:
-			if wait_once:
-				s = submission_queue.get(timeout=10)
-				wait_once = False
-			else:
-				s = submission_queue.get_nowait()
-			if s.created_utc <= env.state.streamed_submissions_until_timestamp.timestamp():
-				logger.debug(f"Skipping post older than {env.state.streamed_submissions_until_timestamp}: {s.title}")
-			else:
-				env.state.streamed_submissions_until_timestamp = datetime.fromtimestamp(s.created_utc, timezone.utc)
-				if already_streamed(env, s):
-					logger.info(f"Skipping already streamed post: {s.id}, {s.title}")
-				else:
-					env.state.streamed_submissions.append(StreamedSubmission(id=s.id, timestamp=datetime.fromtimestamp(s.created_utc, timezone.utc)))
-		except queue.Empty:
-			break
-	submissions_newer_than_max_age: list[StreamedSubmission] = []
-	for s in env.state.streamed_submissions:
-		if s.timestamp > datetime.now(timezone.utc) - timedelta(hours=env.agent_config.max_post_age_for_replying_hours):
-			submissions_newer_than_max_age.append(s)
+	if wait_once and not submission_queue:
+		new_event_available.wait(timeout=10)  # Set by the streaming thread once its first batch of posts is queued
+	submissions = drain_submission_queue()
+	# Without new submissions there's nothing to do, other than dropping expired posts once in a while.
+	# Posts expire after hours, so checking once a minute is enough.
+	if not submissions and (not env.state.streamed_submissions or time.monotonic() - env.submissions_pruned_at < AGE_FILTER_INTERVAL_SECONDS):
+		return
+	until_timestamp = env.state.streamed_submissions_until_timestamp.timestamp()  # Compared as a float, like created_utc
+	for s in submissions:
+		if s.created_utc <= until_timestamp:
+			logger.debug(f"Skipping post older than {env.state.streamed_submissions_until_timestamp}: {s.title}")
 		else:
-			logger.info(f"Removing post older than {env.agent_config.max_post_age_for_replying_hours} hours: {s.timestamp}")
-	env.state.streamed_submissions = submissions_newer_than_max_age
-	max_streamed_submissions = 8
-	env.state.streamed_submissions = env.state.streamed_submissions[-max_streamed_submissions:]
-	env.save_state()
+			until_timestamp = s.created_utc
+			timestamp = datetime.fromtimestamp(s.created_utc, timezone.utc)
+			env.state.streamed_submissions_until_timestamp = timestamp
+			if env.state.is_streamed(s.id):
+				logger.info(f"Skipping already streamed post: {s.id}, {s.title}")
+			else:
+				env.state.add_streamed_submission(StreamedSubmission(id=s.id, timestamp=timestamp))
+			env.state_dirty = True
+	# Submissions are only added when newer than streamed_submissions_until_timestamp, so they are ordered by timestamp
+	# and the expired ones are all at the front
+	cutoff = datetime.now(timezone.utc) - timedelta(hours=env.agent_config.max_post_age_for_replying_hours)
+	removed_count = 0
+	while env.state.streamed_submissions and env.state.streamed_submissions[0].timestamp <= cutoff:
+		env.state.streamed_submissions.popleft()
+		removed_count += 1
+	if removed_count > 0:
+		logger.info(f"Removed {removed_count} posts older than {env.agent_config.max_post_age_for_replying_hours} hours")
+		env.state.refresh_streamed_ids()
+		env.state_dirty = True
+	env.submissions_pruned_at = time.monotonic()
 
 
 def handle_submissions(env: AgentEnv):
-	subreddit = env.reddit.subreddit("+".join(env.agent_config.active_on_subreddits))
+	subreddit = env.reddit.subreddit(env.joined_subreddits)
 	logger.info(f"Monitoring subreddit: {subreddit.display_name}")
-	for s in subreddit.stream.submissions():
-		if s.author == get_current_user(env.reddit).name:
+	max_post_age_for_replying_hours = env.agent_config.max_post_age_for_replying_hours
+	max_post_age_seconds = max_post_age_for_replying_hours * 3600
+	own_username = env.current_username
+	queued_since_wakeup = False
+	idle_delay = ExponentialCounter(max_counter=STREAM_MAX_IDLE_SECONDS)
+	# With pause_after=0 the stream yields None once it has caught up, so the main loop is woken once per batch of new posts
+	for s in subreddit.stream.submissions(pause_after=0):
+		if s is None:
+			if queued_since_wakeup:
+				new_event_available.set()
+				queued_since_wakeup = False
+			time.sleep(idle_delay.counter())
+			continue
+		idle_delay.reset()
+		if s.author == own_username:  # Redditor compares case-insensitively by name to a str, no request needed
 			logger.debug(f"Skipping own post: {s.id}, {s.title}")
 			continue
 		if not s.is_self:
 			logger.debug(f"Skipping post without text: {s.id}, {s.title}")
 			continue
+		# The stream runs indefinitely, so the cutoff has to follow the clock, but a float comparison is enough for it
+		is_too_old = s.created_utc < time.time() - max_post_age_seconds
 		timestamp = datetime.fromtimestamp(s.created_utc, timezone.utc)
-		max_post_age_for_replying_hours = env.agent_config.max_post_age_for_replying_hours
-		if timestamp < datetime.now(timezone.utc) - timedelta(hours=max_post_age_for_replying_hours):
+		if is_too_old:
 			logger.debug(f"Skipping post older than {max_post_age_for_replying_hours} hours: {timestamp} {s.id}, {s.title}")
 		else:
 			logger.debug(f"Queuing new post: {timestamp} {s.id}, {s.title}")
-			submission_queue.put(s)
+			submission_queue.append(s)
+			queued_since_wakeup = True
+
+
+# Called by PRAW inside its except block when fetching from a stream fails. PRAW then waits with an
+# increasing delay and retries, so a network or API error doesn't end the thread the stream runs in.
+def log_stream_error(exception: Exception):
+	logger.error(f"Error in inbox stream, retrying: {exception!r}")
+	logger.exception()
+
+
+# Streams the ids of unread inbox comments into env.inbox_comment_ids, which the main loop handles one per event.
+# Each unread item is yielded once, so the inbox is no longer listed as a whole.
+# PRAW's Reddit instances aren't thread-safe, so the stream uses env.inbox_reddit, which only this thread uses.
+# Only the ids are passed on, the main loop loads the comments through env.reddit.
+def handle_inbox(env: AgentEnv):
+	queued_since_wakeup = False
+	idle_delay = ExponentialCounter(max_counter=STREAM_MAX_IDLE_SECONDS)
+	for item in env.inbox_reddit.inbox.stream(pause_after=0, exception_handler=log_stream_error):
+		if item is None:
+			if queued_since_wakeup:
+				new_event_available.set()
+				queued_since_wakeup = False
+			time.sleep(idle_delay.counter())
+			continue
+		idle_delay.reset()
+		if isinstance(item, Comment):
+			logger.debug(f"Queuing new inbox comment: {item.id}")
+			env.inbox_comment_ids.append(item.id)
+			queued_since_wakeup = True
 
 
 def append_to_history(env: AgentEnv, history_item: HistoryItem):
-	env.state.history.append(history_item)
-	if len(env.state.history) > env.agent_config.max_history_length:
-		env.state.history = env.state.history[-env.agent_config.max_history_length:]
+	env.state.history.append(history_item)  # The deque's maxlen drops the oldest items
+	env.state_dirty = True
+	env.history_prompt = None
 
 
+# Saved right away, since the result belongs to an action that has already been performed on Reddit
 def save_result(env: AgentEnv, history_item: HistoryItem):
 	append_to_history(env, history_item)
 	env.save_state()
@@ -147,51 +208,69 @@ def handle_inbox_message(env: AgentEnv, system_prompt: str, comment_id: str):
 
 
 def get_system_prompt_for_event(env: AgentEnv, event_message: str) -> str:
-	event_prompt = [
-	    "## Event message:",
-	    event_message,
-	    "",
-	    NOTES_INSTRUCTIONS,
-	]
+	head, tail = get_system_prompt_parts(env.agent_config.agent_instructions, env.current_username, env.subreddits_display)
+	return SYSTEM_PROMPT_TEMPLATE.format_map({
+	    'head': head,
+	    'history': get_history_prompt(env),
+	    'tail': tail,
+	    'event_message': event_message,
+	})
+
+
+MAX_COMMENT_TREE_SIZE = 20
+
+
+# Loads the post and its comment tree. The tree is None for posts whose author is unknown, e.g. deleted posts.
+def fetch_post(env: AgentEnv, submission_id: str) -> tuple[Submission, SubmissionTreeNode | None]:
+	submission = env.reddit.submission(submission_id)
+	if not submission.author:
+		return submission, None
+	return submission, get_comment_tree(submission, MAX_COMMENT_TREE_SIZE)
+
+
+def handle_inbox_comment(env: AgentEnv, comment: Comment):
+	conversation = show_conversation(comment)
+	json_msg = json_dumps_compact(conversation)
+
+	fmtlog([
+	    FmtHeader(3, "New inbox comment event:"),
+	    FmtText(f"From: {get_author_name(comment)}"),
+	    FmtText(f"Comment: {comment.body}"),
+	    FmtText(f"Link: https://reddit.com{comment.context}"),
+	])
 
-	system_prompt = "\n".join(get_leading_system_prompt(env) + [""] + event_prompt)
-	return system_prompt
+	event_message = f"You have a new comment in your inbox. Here is the conversation:\n\n```json\n{json_msg}\n```"
+	system_prompt = get_system_prompt_for_event(env, event_message)
+	handle_inbox_message(env, system_prompt, COMMENT_PREFIX + comment.id)
 
 
 def handle_new_event(env: AgentEnv):
 
 	fmtlog([FmtText("Waiting for event...")])
-	comments = list_inbox_comments(env.reddit)
-	fmtlog([FmtText(f"Number of messages in inbox: {len(comments)}")])
+	comment_ids = env.inbox_comment_ids
+	fmtlog([FmtText(f"Number of messages in inbox: {len(comment_ids)}")])
 	fmtlog([FmtText(f"Number of unread posts: {len(env.state.streamed_submissions)}")])
 	stream_submissions_to_state(env)
-	if len(comments) > 0:
-		comment = comments[0]
-		conversation = show_conversation(env.reddit, comment.id)
-		json_msg = json.dumps(conversation, ensure_ascii=False, indent=2)
-
-		fmtlog([
-		    FmtHeader(3, "New inbox comment event:"),
-		    FmtText(f"From: {get_author_name(comment)}"),
-		    FmtText(f"Comment: {comment.body}"),
-		    FmtText(f"Link: https://reddit.com{comment.context}"),
-		])
-
-		event_message = f"You have a new comment in your inbox. Here is the conversation:\n\n```json\n{json_msg}\n```"
-		system_prompt = get_system_prompt_for_event(env, event_message)
-		handle_inbox_message(env, system_prompt, COMMENT_PREFIX + comment.id)
-
-		if not env.test_mode or confirm_yes_no("Mark comment as read?"):
-			comment.mark_read()
+	if len(comment_ids) > 0:
+		comment = env.reddit.comment(comment_ids[0])
+		try:
+			handle_inbox_comment(env, comment)
+		except Exception:
+			# Moved to the back, so that a comment that keeps failing doesn't block the other comments and the posts
+			logger.exception()
+			logger.error(f"Could not handle inbox comment {comment.id}, retrying it after the other comments")
+			comment_ids.rotate(-1)
+		else:
+			if not env.test_mode or confirm_yes_no("Mark comment as read?"):
+				comment_ids.popleft()  # Removed first, so that the comment isn't replied to again if marking it fails
+				comment.mark_read()
 
 	if len(env.state.streamed_submissions) > 0:
-		latest_submission = env.reddit.submission(env.state.streamed_submissions[-1].id)
-		if not latest_submission.author:
+		latest_submission, comment_tree = fetch_post(env, env.state.streamed_submissions[-1].id)
+		if comment_tree is None:
 			logger.info(f"Skipping post with unknown author: {latest_submission.id}, {latest_submission.title}")
 		else:
-			max_comment_tree_size = 20
-			comment_tree = get_comment_tree(latest_submission, max_comment_tree_size)
-			json_msg = json.dumps(comment_tree.to_dict(), ensure_ascii=False, indent=2)
+			json_msg = json_dumps_compact(comment_tree)
 
 			fmtlog([
 			    FmtHeader(3, "New post event:"),
@@ -202,11 +281,13 @@ def handle_new_event(env: AgentEnv):
 			    FmtText(f"Text: {latest_submission.selftext}"),
 			])
 
-			event_message = f"You have a new post in the monitored subreddits. Here is the conversation tree, with the up to {max_comment_tree_size} highest rated comments:\n\n```json\n{json_msg}\n```"
+			event_message = f"You have a new post in the monitored subreddits. Here is the conversation tree, with the up to {MAX_COMMENT_TREE_SIZE} highest rated comments:\n\n```json\n{json_msg}\n```"
 			system_prompt = get_system_prompt_for_event(env, event_message)
 			handle_new_post(env, system_prompt, comment_tree)
 		if not env.test_mode or confirm_yes_no("Remove post from stream?"):
 			del env.state.streamed_submissions[-1]
+			env.state.refresh_streamed_ids()
+			env.state_dirty = True
 	else:
 		fmtlog([FmtText("No new events.")])
 		return
@@ -221,16 +302,11 @@ system_intro = " ".join([
 ])
 
 
-def get_leading_system_prompt(env: AgentEnv) -> list[str]:
-
-	history: list[str] = []
-	if len(env.state.history) > 0:
-		for i, history_item in enumerate(env.state.history):
-			history.append(f"History item {i}: {history_item.notes_and_strategy}")
-	else:
-		history.append("(No history yet)")
-
-	return [
+# The parts of the system prompt around the history only depend on the configuration and the user,
+# so they are built once and reused for every event
+@functools.lru_cache(maxsize=4)
+def get_system_prompt_parts(agent_instructions: str, username: str, subreddits_display: str) -> tuple[str, str]:
+	head = "\n".join([
 	    system_intro,
 	    "",
 	    f"You will be provided with:",
@@ -238,15 +314,27 @@ def get_leading_system_prompt(env: AgentEnv) -> list[str]:
 	    "A list of available commands to perform your actions.",
 	    "",
 	    "## Agent instructions:",
-	    env.agent_config.agent_instructions,
+	    agent_instructions,
 	    "",
 	    "## History (your notes on previous actions):",
-	    *history,
+	])
+	tail = "\n".join([
 	    "",
 	    "## Current status:",
-	    f"Your username is '{get_current_user(env.reddit).name}'.",
-	    f"You are active on the following subreddits: {', '.join(env.agent_config.active_on_subreddits)}",
-	]
+	    f"Your username is '{username}'.",
+	    f"You are active on the following subreddits: {subreddits_display}",
+	])
+	return head, tail
+
+
+# Rendered once per change of the history. The item numbers shift when the oldest item is dropped, so it's rendered as a whole.
+def get_history_prompt(env: AgentEnv) -> str:
+	if env.history_prompt is None:
+		if env.state.history:
+			env.history_prompt = "\n".join(f"History item {i}: {history_item.notes_and_strategy}" for i, history_item in enumerate(env.state.history))
+		else:
+			env.history_prompt = "(No history yet)"
+	return env.history_prompt
 
 
 @dataclass
@@ -259,12 +347,30 @@ NOTES_INSTRUCTIONS = """You should also provide notes and strategy for the actio
 It should include a summary of the event and your response to it. For example, "I replied to a comment about X with Y, with the goal of Z."
 This will help you keep track of your strategy and make sure you are working towards your goals."""
 
+# Filled in with a single format_map() call per event. The static parts are joined into the template once.
+SYSTEM_PROMPT_TEMPLATE = "\n".join([
+    "{head}",
+    "{history}",
+    "{tail}",
+    "",
+    "## Event message:",
+    "{event_message}",
+    "",
+    NOTES_INSTRUCTIONS.replace("{", "{{").replace("}", "}}"),
+])
+
 
 def run_agent(env: AgentEnv):
 	stream_submissions_thread = threading.Thread(target=handle_submissions, args=(env, ))
 	stream_submissions_thread.daemon = True
 	stream_submissions_thread.start()
+	stream_inbox_thread = threading.Thread(target=handle_inbox, args=(env, ))
+	stream_inbox_thread.daemon = True
+	stream_inbox_thread.start()
+	# Changes since the last event are written when the agent is stopped, e.g. with Ctrl+C
+	atexit.register(env.save_state_if_dirty)
 	stream_submissions_to_state(env, wait_once=True)
+	env.save_state_if_dirty()
 
 	while True:
 
@@ -273,9 +379,11 @@ def run_agent(env: AgentEnv):
 			handle_new_event(env)
 		except Exception:
 			logger.exception()
+		env.save_state_if_dirty()
 
 		if env.test_mode:
 			confirm_enter()
 		else:
-			print("Wait for 10 seconds before handling the next event.")
-			time.sleep(10)
+			print("Wait for a new event, at most 10 seconds, before handling the next event.")
+			new_event_available.wait(timeout=10)
+			new_event_available.clear()
@@ -1,10 +1,15 @@
+from collections import deque
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
+from functools import cached_property
 import os
 from praw import Reddit  # type: ignore
 from src.providers.base_provider import BaseProvider
 from src.pydantic_models.agent_state import AgentState
 from src.pydantic_models.agent_config import AgentConfig
+from src.reddit_utils import get_current_user
+
+MAX_STREAMED_SUBMISSIONS = 8
 
 
 @dataclass
@@ -13,17 +18,41 @@ class AgentEnv:
 	agent_config: AgentConfig
 	provider: BaseProvider
 	reddit: Reddit
+	inbox_reddit: Reddit  # A separate instance for the inbox stream's thread, since Reddit instances aren't thread-safe
 	test_mode: bool
+	configured_username: str | None = None  # The username from reddit_config.yaml, if set
 	state: AgentState = field(init=False)
+	joined_subreddits: str = field(init=False)  # Multireddit name for streaming, e.g. 'sub1+sub2'
+	subreddits_display: str = field(init=False)  # e.g. 'sub1, sub2'
+	inbox_comment_ids: deque[str] = field(init=False, default_factory=deque)  # Ids of unread inbox comments not yet handled, filled by the inbox stream
+	submissions_pruned_at: float = field(init=False, default=float('-inf'))  # time.monotonic() of the last age filtering of streamed submissions
+	state_dirty: bool = field(init=False, default=False)  # The state has changes that aren't written to the state file yet
+	history_prompt: str | None = field(init=False, default=None)  # The history as rendered for the system prompt, None when it has changed
 
 	def __post_init__(self):
+		self.joined_subreddits = "+".join(self.agent_config.active_on_subreddits)
+		self.subreddits_display = ", ".join(self.agent_config.active_on_subreddits)
 		if os.path.exists(self.state_filename):
-			with open(self.state_filename) as f:
-				whole_file_as_string = f.read()
-				self.state = AgentState.model_validate_json(whole_file_as_string)
+			with open(self.state_filename, 'rb') as f:
+				self.state = AgentState.model_validate_json(f.read())
 		else:
-			self.state = AgentState(history=[], streamed_submissions=[], streamed_submissions_until_timestamp=datetime.fromtimestamp(0, timezone.utc))
+			self.state = AgentState(streamed_submissions_until_timestamp=datetime.fromtimestamp(0, timezone.utc))
+		self.state.set_max_lengths(self.agent_config.max_history_length, MAX_STREAMED_SUBMISSIONS)
+
+	# The logged in user can't change while running, so it's only looked up once, and not at all when configured
+	@cached_property
+	def current_username(self) -> str:
+		return self.configured_username or get_current_user(self.reddit).name
 
+	# Written to a temporary file first, so that an interrupted write can't leave a truncated state file behind
 	def save_state(self):
-		with open(self.state_filename, 'w') as f:
-			f.write(self.state.model_dump_json(indent=2))
+		tmp_filename = self.state_filename + '.tmp'
+		with open(tmp_filename, 'w') as f:
+			f.write(self.state.model_dump_json())  # Compact, the file is only read back by the agent
+		os.replace(tmp_filename, self.state_filename)
+		self.state_dirty = False
+
+	# Changes that can be lost without side effects are written once per event instead of after each change
+	def save_state_if_dirty(self):
+		if self.state_dirty:
+			self.save_state()
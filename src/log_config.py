@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
+import atexit
 from enum import IntEnum
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
 import traceback
 
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
@@ -33,13 +36,18 @@ class StdStreamLogger(BaseLogger):
 			self.logger.log(level, message)
 
 
+# Records are handed over to a background thread that formats and writes them, so file I/O doesn't block the caller
 class FileLogger(BaseLogger):
 	def __init__(self, file_path: str, log_level: int):
 		self.log_level = log_level
 		self.logger = logging.Logger('app.FileLogger')
-		log_handler = logging.FileHandler(file_path)
-		log_handler.setFormatter(logging.Formatter(style='{', fmt='{levelname:8} {asctime} {message}', datefmt=DATE_FORMAT))
-		self.logger.addHandler(log_handler)
+		file_handler = logging.FileHandler(file_path)
+		file_handler.setFormatter(logging.Formatter(style='{', fmt='{levelname:8} {asctime} {message}', datefmt=DATE_FORMAT))
+		log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+		self.listener = QueueListener(log_queue, file_handler)
+		self.listener.start()
+		atexit.register(self.listener.stop)  # Writes out the remaining records on exit
+		self.logger.addHandler(QueueHandler(log_queue))
 		self.logger.setLevel(log_level)
 
 	def log(self, level: int, message: str):
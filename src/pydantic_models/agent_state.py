@@ -1,6 +1,7 @@
+from collections import deque
 from datetime import datetime, timezone
-from typing import List
-from pydantic import BaseModel, Field
+from typing import Any, Deque
+from pydantic import BaseModel, Field, PrivateAttr
 
 
 class HistoryItem(BaseModel):
@@ -13,15 +14,38 @@ class StreamedSubmission(BaseModel):
 
 
 class AgentState(BaseModel):
-	history: List[HistoryItem] = Field(
+	history: Deque[HistoryItem] = Field(
 	    description='Action and result history of the agent',
-	    default=[],
+	    default_factory=deque,
 	)
-	streamed_submissions: List[StreamedSubmission] = Field(
+	streamed_submissions: Deque[StreamedSubmission] = Field(
 	    description='The submissions that have been streamed to the state',
-	    default=[],
+	    default_factory=deque,
 	)
 	streamed_submissions_until_timestamp: datetime = Field(
 	    description='The timestamp until which submissions have been streamed to the agent state',
 	    default=datetime.fromtimestamp(0, timezone.utc),
 	)
+	# Ids of streamed_submissions, for constant time lookups. Not persisted, rebuilt from the list when loaded.
+	_streamed_ids: set[str] = PrivateAttr(default_factory=set)
+
+	def model_post_init(self, __context: Any):
+		self.refresh_streamed_ids()
+
+	# Bounds the history and the streamed submissions, appending to a full deque drops its oldest item
+	def set_max_lengths(self, max_history_length: int, max_streamed_submissions: int):
+		self.history = deque(self.history, maxlen=max_history_length)
+		self.streamed_submissions = deque(self.streamed_submissions, maxlen=max_streamed_submissions)
+		self.refresh_streamed_ids()
+
+	def refresh_streamed_ids(self):
+		self._streamed_ids = {s.id for s in self.streamed_submissions}
+
+	def is_streamed(self, submission_id: str) -> bool:
+		return submission_id in self._streamed_ids
+
+	def add_streamed_submission(self, submission: StreamedSubmission):
+		if len(self.streamed_submissions) == self.streamed_submissions.maxlen:
+			self._streamed_ids.discard(self.streamed_submissions[0].id)
+		self.streamed_submissions.append(submission)
+		self._streamed_ids.add(submission.id)
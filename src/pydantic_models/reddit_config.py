@@ -7,3 +7,4 @@ class RedditConfig(BaseModel):
 	client_secret: str = Field(..., description='The client secret of the Reddit app')
 	refresh_token: Optional[str] = Field(None, description='The refresh token of the Reddit app')
 	user_agent: Optional[str] = Field(None, description='The user agent of the Reddit app')
+	username: Optional[str] = Field(None, description='The Reddit username of the account. Looked up through the API when not set')
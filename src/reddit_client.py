@@ -0,0 +1,11 @@
+from praw import Reddit  # type: ignore
+
+
+def get_reddit_client(client_id: str, client_secret: str, user_agent: str, *, refresh_token: str | None = None, redirect_uri: str | None = None) -> Reddit:
+	return Reddit(
+	    client_id=client_id,
+	    client_secret=client_secret,
+	    user_agent=user_agent,
+	    refresh_token=refresh_token,
+	    redirect_uri=redirect_uri,
+	)
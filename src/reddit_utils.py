@@ -1,11 +1,10 @@
 from dataclasses import dataclass, field
-import os
-from typing import Any
-import yaml
 from praw import Reddit  # type: ignore
+from praw.exceptions import ClientException  # type: ignore
 from praw.models import Comment, Submission, Redditor, MoreComments  # type: ignore
 from praw.models.comment_forest import CommentForest  # type: ignore
 from src.pydantic_models.reddit_config import RedditConfig
+from src.utils import load_model_file
 
 REDDIT_CONFIG_FILENAME = 'config/reddit_config.yaml'
 
@@ -15,13 +14,11 @@ class LoadConfigException(Exception):
 
 
 def load_reddit_config(*, auth_session: bool = False):
-	if os.path.exists(REDDIT_CONFIG_FILENAME):
-		with open(REDDIT_CONFIG_FILENAME) as f:
-			config_obj = yaml.safe_load(f)
-	else:
+	try:
+		config = load_model_file(REDDIT_CONFIG_FILENAME, RedditConfig)
+	except FileNotFoundError:
 		raise LoadConfigException(
-		    f"File {REDDIT_CONFIG_FILENAME} not found. Create it by copying {REDDIT_CONFIG_FILENAME}.example to {REDDIT_CONFIG_FILENAME} and filling in the values.")
-	config = RedditConfig(**config_obj)
+		    f"File {REDDIT_CONFIG_FILENAME} not found. Create it by copying {REDDIT_CONFIG_FILENAME}.example to {REDDIT_CONFIG_FILENAME} and filling in the values.") from None
 	if not config.user_agent or config.user_agent == "":
 		config.user_agent = f"Regent"
 	if not auth_session:
@@ -34,17 +31,21 @@ COMMENT_PREFIX = 't1_'
 SUBMISSION_PREFIX = 't3_'
 
 
-def get_comment_chain(comment: Comment, reddit: Reddit) -> tuple[Submission, list[Comment]]:
-	if comment.parent_id.startswith(COMMENT_PREFIX):
-		parent_comment = reddit.comment(id=comment.parent_id)
-		root_submission, comments = get_comment_chain(parent_comment, reddit)
-		return root_submission, comments + [comment]
-	elif comment.parent_id.startswith(SUBMISSION_PREFIX):
-		id_without_prefix = comment.parent_id[len(SUBMISSION_PREFIX):]
-		submission = reddit.submission(id=id_without_prefix)
-		return submission, [comment]
-	else:
-		raise ValueError(f"Invalid parent_id: {comment.parent_id}")
+# Comments from a refresh() come with up to 8 levels of parents, which parent() then returns without further requests.
+# Refreshing every 9 levels (as suggested in PRAW's docs for parent()) takes one request per 9 levels instead of one per comment.
+def get_comment_chain(comment: Comment) -> tuple[Submission, list[Comment]]:
+	comments: list[Comment] = []
+	item: Comment | Submission = comment
+	while isinstance(item, Comment):
+		if len(comments) % 9 == 0:
+			try:
+				item.refresh()
+			except ClientException:
+				pass  # E.g. a deleted comment, its parents are then fetched one by one
+		comments.append(item)
+		item = item.parent()
+	comments.reverse()
+	return item, comments
 
 
 def get_author_name(item: Comment | Submission) -> str:
@@ -60,14 +61,8 @@ def get_current_user(reddit: Reddit) -> Redditor:
 	return current_user
 
 
-def list_inbox_comments(reddit: Reddit) -> list[Comment]:
-	items = reddit.inbox.unread(limit=None)  # type: ignore
-	return [i for i in items if isinstance(i, Comment)]
-
-
-def show_conversation(reddit: Reddit, comment_id: str) -> list[dict[str, str]]:
-	comment = reddit.comment(comment_id)
-	root_submission, comments = get_comment_chain(comment, reddit)
+def show_conversation(comment: Comment) -> list[dict[str, str]]:
+	root_submission, comments = get_comment_chain(comment)
 	items: list[dict[str, str]] = []
 	items.append({
 	    'content_id': SUBMISSION_PREFIX + root_submission.id,
@@ -84,43 +79,25 @@ def show_conversation(reddit: Reddit, comment_id: str) -> list[dict[str, str]]:
 	return items
 
 
+# The tree nodes are serialized as-is (see json_dumps_compact), so the field order is the order of the keys in the JSON
 @dataclass
 class SubmissionTreeNode:
+	content_id: str
 	subreddit: str
 	author: str
 	title: str
 	text: str
-	content_id: str
 	replies: list['CommentTreeNode'] = field(default_factory=list)  # type: ignore
 
-	def to_dict(self) -> dict[str, Any]:
-		return {
-		    'content_id': self.content_id,
-		    'subreddit': self.subreddit,
-		    'author': self.author,
-		    'title': self.title,
-		    'text': self.text,
-		    'replies': [r.to_dict() for r in self.replies],
-		}
-
 
 @dataclass
 class CommentTreeNode:
+	content_id: str
 	author: str
 	text: str
-	content_id: str
 	score: int
 	replies: list['CommentTreeNode'] = field(default_factory=list)  # type: ignore
 
-	def to_dict(self) -> dict[str, Any]:
-		return {
-		    'content_id': self.content_id,
-		    'author': self.author,
-		    'text': self.text,
-		    'score': self.score,
-		    'replies': [r.to_dict() for r in self.replies],
-		}
-
 
 def get_comment_tree_recursive(comments: CommentForest) -> list[CommentTreeNode]:
 	items: list[CommentTreeNode] = []
@@ -1,16 +1,71 @@
+import dataclasses
 import json
-from typing import Any
+import os
+from typing import Any, TypeVar
 import yaml
+from pydantic import BaseModel
 import unittest
 
+try:
+	import orjson
+except ImportError:
+	orjson = None  # Optional, the standard json module is used when it's not installed
+
+ModelT = TypeVar('ModelT', bound=BaseModel)
+
+# libyaml-backed loader and dumper when PyYAML was built with it, pure-Python otherwise
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+def yaml_load(text: str | bytes) -> Any:
+	return yaml.load(text, Loader=YamlLoader)
+
+
+# Reads a whole file without the buffered io layer, config files are typically read with a single os.read()
+def read_file_bytes(path: str) -> bytes:
+	fd = os.open(path, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+	try:
+		return b''.join(iter(lambda: os.read(fd, 65536), b''))
+	finally:
+		os.close(fd)
+
+
+# Parses a YAML (or JSON) file
+def load_yaml_file(path: str) -> Any:
+	data = read_file_bytes(path)
+	if path.endswith('.json'):
+		return json_loads(data)  # JSON is valid YAML, but doesn't need the YAML parser
+	return yaml_load(data)  # libyaml decodes UTF-8 itself, so skip the text layer
+
+
+# Loads a YAML file into a pydantic model
+def load_model_file(path: str, model_cls: type[ModelT]) -> ModelT:
+	return model_cls(**load_yaml_file(path))
+
 
 def yaml_dump(obj: Any) -> str:
-	return yaml.dump(obj, default_flow_style=False, allow_unicode=True, sort_keys=False)
+	return yaml.dump(obj, Dumper=YamlDumper, default_flow_style=False, allow_unicode=True, sort_keys=False)
+
+
+# Compact JSON for prompts, where whitespace only adds tokens.
+# Dataclass instances, also nested ones, are serialized like dicts of their fields. orjson does this natively, without building the dicts.
+def json_dumps_compact(obj: Any) -> str:
+	if orjson:
+		return orjson.dumps(obj).decode()
+	return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=dataclasses.asdict)
+
+
+# orjson.JSONDecodeError is a subclass of json.JSONDecodeError, so callers can catch the latter either way
+def json_loads(data: str | bytes) -> Any:
+	if orjson:
+		return orjson.loads(data)
+	return json.loads(data)
 
 
 def json_to_yaml(json_str: str) -> str:
 	try:
-		obj = json.loads(json_str)
+		obj = json_loads(json_str)
 		return yaml_dump(obj)
 	except json.JSONDecodeError:
 		return json_str